@@ -1,4 +1,3 @@
-import cv2
 import subprocess
 import csv
 import time
@@ -6,126 +5,389 @@ import os
 import sys
 import threading
 import logging
+import logging.handlers
 import signal
+import select
+import re
+import random
 import atexit
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    filename='stream.log', filemode='a')
 logger = logging.getLogger('rtsp_to_rtmp_streamer')
 
-# Add console handler for log output
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logger.addHandler(console)
+# Re-encode video with libx264 instead of passing the camera's H.264 through
+TRANSCODE_VIDEO = os.environ.get('STREAM_TRANSCODE', '0') == '1'
 
-def is_rtsp_url_valid(rtsp_url):
-    """Check if RTSP URL is valid by trying to connect to it"""
+# Remux every camera in a single FFmpeg process instead of one per camera. Only
+# used without transcoding and with FFmpeg 7+, whose verbose log tells when one
+# camera's output ends. Any camera failing restarts the process, and with it the
+# other cameras; cameras that fail their probe are retried with backoff.
+COMBINE_STREAMS = os.environ.get('STREAM_COMBINE', '0') == '1'
+COMBINED_STREAM_ID = 'combined'
+
+# Restart policy for streams that die: exponential backoff capped at
+# MAX_RESTART_BACKOFF seconds, dropping the camera after MAX_RESTART_ATTEMPTS
+MAX_RESTART_BACKOFF = 60
+MAX_RESTART_ATTEMPTS = 10
+
+# Per-stream FFmpeg thread count and input packet queue size
+FFMPEG_THREADS = os.environ.get('STREAM_FFMPEG_THREADS', '1')
+THREAD_QUEUE_SIZE = os.environ.get('STREAM_THREAD_QUEUE_SIZE', '512')
+
+# Major version of the installed FFmpeg, read from 'ffmpeg -version' by main().
+# None for unversioned git builds, which are treated as current.
+FFMPEG_MAJOR_VERSION = None
+
+# Encoders, hwaccels and verified hardware decode paths of the installed FFmpeg
+# build, filled in once by main()
+FFMPEG_CAPS = {'encoders': set(), 'hwaccels': set(), 'hw_decode': set()}
+
+# Hardware encoders in order of preference, with the hwaccel and options used to
+# decode on the same device
+HWACCEL_INPUT_ARGS = {
+    'h264_nvenc': ('cuda', ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-c:v', 'h264_cuvid']),
+    'h264_qsv': ('qsv', ['-hwaccel', 'qsv', '-c:v', 'h264_qsv']),
+    'h264_v4l2m2m': (None, ['-c:v', 'h264_v4l2m2m']),
+}
+
+ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p1', '-tune', 'll', '-rc', 'cbr', '-b:v', '2M', '-g', '30'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-b:v', '2M', '-g', '30'],
+    'h264_v4l2m2m': ['-c:v', 'h264_v4l2m2m', '-b:v', '2M', '-pix_fmt', 'yuv420p', '-g', '30'],
+    'libx264': [
+        '-c:v', 'libx264',             # Software H.264 encoding
+        '-preset', 'ultrafast',        # Minimize encoding latency
+        '-tune', 'zerolatency',        # Optimize for streaming
+        # CBR with no lookahead or B-frames and a fixed 30-frame keyframe interval
+        '-x264-params', 'nal-hrd=cbr:force-cfr=1:sliced-threads=0:bframes=0:rc-lookahead=0:'
+                        'sync-lookahead=0:keyint=30:min-keyint=30',
+        '-profile:v', 'baseline',      # Use baseline profile for compatibility
+        '-b:v', '2000k',               # Target bitrate
+        '-maxrate', '2000k',           # Maximum bitrate
+        '-bufsize', '1000k',           # Half of maxrate to limit encoder hold-back
+        '-pix_fmt', 'yuv420p',         # Standard pixel format
+    ],
+}
+
+def parse_ffmpeg_major_version(version_output):
+    """Extract the major version from 'ffmpeg -version' output, or None if unversioned"""
+    match = re.search(r'version n?(\d+)\.', version_output)
+    return int(match.group(1)) if match else None
+
+def rtsp_timeout_args(microseconds):
+    """RTSP socket timeout options for the installed FFmpeg"""
+    # Before FFmpeg 5, RTSP -timeout meant "wait for incoming connections" and
+    # switched to listen mode; the socket timeout was called -stimeout
+    if FFMPEG_MAJOR_VERSION is not None and FFMPEG_MAJOR_VERSION < 5:
+        return ['-stimeout', str(microseconds)]
+    return ['-timeout', str(microseconds)]
+
+def hw_encoder_works(encoder):
+    """Check that a hardware encoder can encode a frame on this machine with our settings"""
+    command = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=s=256x256',
+        '-frames:v', '1',
+        *ENCODER_ARGS[encoder],
+        '-f', 'null', '-'
+    ]
     try:
-        cap = cv2.VideoCapture(rtsp_url)
-        if not cap.isOpened():
-            logger.error(f"Failed to open RTSP stream: {rtsp_url}")
-            return False
+        return subprocess.run(command, capture_output=True, timeout=10).returncode == 0
+    except (subprocess.SubprocessError, OSError):
+        return False
+
+def hw_decode_works(encoder, hwaccels):
+    """Check that the hardware decode options paired with an encoder can decode its output"""
+    hwaccel, input_args = HWACCEL_INPUT_ARGS[encoder]
+    if hwaccel is not None and hwaccel not in hwaccels:
+        return False
+    
+    encode = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=s=256x256',
+              '-frames:v', '5', '-c:v', encoder, '-f', 'h264', '-']
+    decode = ['ffmpeg', '-hide_banner', '-loglevel', 'error', *input_args, '-f', 'h264', '-i', '-',
+              '-f', 'null', '-']
+    try:
+        sample = subprocess.run(encode, capture_output=True, timeout=10, check=True).stdout
+        return subprocess.run(decode, input=sample, capture_output=True, timeout=10).returncode == 0
+    except (subprocess.SubprocessError, OSError):
+        return False
+
+def detect_ffmpeg_caps():
+    """List the encoders and hardware accelerations the installed FFmpeg supports"""
+    caps = {'encoders': set(), 'hwaccels': set(), 'hw_decode': set()}
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, check=True)
+        listed = set(re.findall(r'^\s*[VAS][A-Z.]{5}\s+([\w-]+)\s', result.stdout, re.MULTILINE))
         
-        ret, frame = cap.read()
-        cap.release()
+        # -encoders shows what was compiled in, not what hardware is present, so
+        # only keep hardware encoders that manage a one-frame test encode
+        caps['encoders'] = {encoder for encoder in listed
+                            if encoder not in HWACCEL_INPUT_ARGS or hw_encoder_works(encoder)}
         
-        if not ret or frame is None:
-            logger.error(f"Failed to read frame from RTSP stream: {rtsp_url}")
-            return False
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-hwaccels'], capture_output=True, text=True, check=True)
+        caps['hwaccels'] = {line.strip() for line in result.stdout.splitlines()[1:] if line.strip()}
+        
+        # Hardware decoders are just as unreliable to detect from the listings, so
+        # decode a few frames from each working hardware encoder with its options
+        caps['hw_decode'] = {encoder for encoder in caps['encoders'] & HWACCEL_INPUT_ARGS.keys()
+                             if hw_decode_works(encoder, caps['hwaccels'])}
+    except (subprocess.SubprocessError, FileNotFoundError) as e:
+        logger.warning(f"Could not detect FFmpeg capabilities: {str(e)}")
+    return caps
+
+def select_h264_encoder():
+    """Pick the fastest H.264 encoder available in the installed FFmpeg build"""
+    for encoder in HWACCEL_INPUT_ARGS:
+        if encoder in FFMPEG_CAPS['encoders']:
+            return encoder
+    return 'libx264'
+
+def setup_logging(daemon_mode):
+    """Log to a rotating stream.log, echoing to the console only when attached to a terminal"""
+    file_handler = logging.handlers.RotatingFileHandler('stream.log', maxBytes=10_000_000, backupCount=3)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        handlers=[file_handler])
+    
+    # Add console handler for log output
+    if not daemon_mode and sys.stderr.isatty():
+        console = logging.StreamHandler()
+        console.setLevel(logging.INFO)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        console.setFormatter(formatter)
+        logger.addHandler(console)
+
+def probe_rtsp_url(rtsp_url):
+    """Probe an RTSP URL with ffprobe, returning its stream types (empty set if unusable)"""
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-rtsp_transport', 'tcp',      # Force TCP for RTSP
+        '-probesize', '32',            # Don't buffer input for codec sniffing
+        '-analyzeduration', '0',
+        *rtsp_timeout_args(2000000),   # Socket timeout in microseconds
+        '-i', rtsp_url,
+        '-show_entries', 'stream=codec_type',
+        '-of', 'csv=p=0'
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=5)
+        if result.returncode != 0:
+            logger.error(f"Failed to open RTSP stream: {rtsp_url}")
+            return set()
+        
+        streams = set(result.stdout.decode(errors='replace').split())
+        if 'video' not in streams:
+            logger.error(f"No video stream found in RTSP stream: {rtsp_url}")
+            return set()
             
         logger.info(f"RTSP URL is valid: {rtsp_url}")
-        return True
+        return streams
+    except subprocess.TimeoutExpired:
+        logger.error(f"Timed out probing RTSP stream: {rtsp_url}")
+        return set()
     except Exception as e:
         logger.error(f"Error validating RTSP URL {rtsp_url}: {str(e)}")
-        return False
+        return set()
 
-def stream_rtsp_to_rtmp(camera_id, rtsp_url, rtmp_url):
-    """Stream from RTSP to RTMP using FFmpeg with proper H.264 handling"""
-    try:
-        # Create log file for this stream
-        log_file = f"{camera_id}.log"
-        log_handle = open(log_file, 'w')
-        
-        # Enhanced FFmpeg command with proper H.264 handling
-        command = [
-            'ffmpeg',
-            '-fflags', 'nobuffer',        # Reduce latency
-            '-rtsp_transport', 'tcp',      # Force TCP for RTSP
-            '-i', rtsp_url,
-            '-c:v', 'libx264',            # Force H.264 encoding
-            '-preset', 'ultrafast',        # Minimize encoding latency
-            '-tune', 'zerolatency',        # Optimize for streaming
-            '-profile:v', 'baseline',      # Use baseline profile for compatibility
-            '-bufsize', '2000k',           # Buffer size
-            '-maxrate', '2000k',           # Maximum bitrate
-            '-pix_fmt', 'yuv420p',         # Standard pixel format
-            '-g', '30',                    # Keyframe interval
+def log_ffmpeg_output(camera_id, stream):
+    """Relay FFmpeg's stderr for one camera into the main log until it closes"""
+    with stream:
+        for line in stream:
+            logger.warning(f"[{camera_id}] {line.rstrip()}")
+
+def watch_combined_output(process, camera_ids):
+    """Relay a combined FFmpeg's warnings per camera, stopping it once any camera's output ends"""
+    with process.stderr as stream:
+        for line in stream:
+            # Lines about one input or output start with e.g. [in#2/rtsp @ 0x...]
+            match = re.match(r'\[(?:in|out)#(\d+)', line)
+            camera_id = camera_ids[int(match.group(1))] if match else COMBINED_STREAM_ID
+            
+            # An input that hits EOF doesn't stop FFmpeg, even with -xerror; only
+            # its output finishes while the other cameras carry on
+            if (match and line.startswith('[out#') and 'All streams finished' in line
+                    and not process.terminating):
+                logger.warning(f"[{camera_id}] Stream ended, restarting the combined stream")
+                process.terminating = True
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            
+            if re.search(r'\[(warning|error|fatal|panic)\] ', line):
+                logger.warning(f"[{camera_id}] {line.rstrip()}")
+
+def build_input_args(rtsp_url, encoder=None):
+    """FFmpeg options for reading one RTSP input, decoding on the encoder's device if any"""
+    args = [
+        '-fflags', 'nobuffer+discardcorrupt',  # Reduce latency, drop broken packets
+        '-flags', 'low_delay',
+        '-rtsp_transport', 'tcp',      # Force TCP for RTSP
+        '-probesize', '32',            # Don't buffer input for codec sniffing
+        '-analyzeduration', '0',
+    ]
+    
+    # Only RTSP demuxer options may go here: FFmpeg rejects input options nothing
+    # consumed, which rules out -reconnect and -rw_timeout. -avioflags direct is
+    # left out as well, since RTSP reads its own sockets and has no AVIO buffer to
+    # bypass. A stalled socket hits this timeout, ends the process and leaves
+    # reconnecting to main()
+    args += rtsp_timeout_args(5000000)
+    
+    if encoder:
+        # Decode on the same device the encoder runs on if that was verified to
+        # work at startup, otherwise in software
+        if encoder in FFMPEG_CAPS['hw_decode']:
+            args += HWACCEL_INPUT_ARGS[encoder][1]
+    
+    return args + [
+        '-threads', FFMPEG_THREADS,    # Cap decoder threads
+        '-thread_queue_size', THREAD_QUEUE_SIZE,
+        '-i', rtsp_url,
+    ]
+
+def build_output_args(rtmp_url, audio, encoder=None):
+    """FFmpeg options for publishing one FLV output, remuxing video unless an encoder is given"""
+    if encoder:
+        args = list(ENCODER_ARGS[encoder])
+    else:
+        args = ['-c:v', 'copy']       # Pass camera H.264 through untouched
+    args += ['-threads', FFMPEG_THREADS]  # Cap encoder threads
+    
+    if audio:
+        args += [
             '-c:a', 'aac',                 # Audio codec
             '-ar', '44100',                # Audio sample rate
             '-b:a', '128k',                # Audio bitrate
-            '-f', 'flv',                   # Output format
-            '-flvflags', 'no_duration_filesize',
-            rtmp_url
         ]
+    else:
+        args += ['-an']                # No audio encoder for silent cameras
+    
+    return args + [
+        '-f', 'flv',                   # Output format
+        '-flvflags', 'no_duration_filesize',
+        rtmp_url
+    ]
+
+def spawn_ffmpeg(command, relay):
+    """Start an FFmpeg process, handing it to relay in a background thread to log its stderr"""
+    logger.debug(f"FFmpeg command: {' '.join(command)}")
+    
+    # Run FFmpeg in subprocess with proper error handling. Without preexec_fn,
+    # Popen spawns via vfork()/posix_spawn, so avoid adding one here.
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors='replace',  # Don't let stray non-UTF-8 bytes kill the relay
+        close_fds=True,
+        start_new_session=True,  # Own process group, so Ctrl-C only reaches us
+        bufsize=1  # Line buffered
+    )
+    
+    # Remember when the stream started, to tell crash loops from one-off failures
+    process.start_time = time.time()
+    # Set once we stop the process on purpose, so its shutdown isn't taken for a failure
+    process.terminating = False
+    
+    # Forward FFmpeg's stderr to our logger in the background
+    threading.Thread(target=relay, args=(process,), daemon=True).start()
+    
+    # Return process so it can be terminated later if needed
+    return process
+
+def stream_rtsp_to_rtmp(camera_id, rtsp_url, rtmp_url, audio=True):
+    """Stream from RTSP to RTMP using FFmpeg with proper H.264 handling"""
+    try:
+        # Video is remuxed as-is unless transcoding is requested
+        encoder = select_h264_encoder() if TRANSCODE_VIDEO else None
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'warning']
+        command += build_input_args(rtsp_url, encoder)
+        command += build_output_args(rtmp_url, audio, encoder)
         
         logger.info(f"Starting stream for {camera_id}: {rtsp_url} -> {rtmp_url}")
-        logger.debug(f"FFmpeg command: {' '.join(command)}")
+        return spawn_ffmpeg(command, lambda process: log_ffmpeg_output(camera_id, process.stderr))
         
-        # Run FFmpeg in subprocess with proper error handling
-        process = subprocess.Popen(
-            command,
-            stdout=log_handle,
-            stderr=log_handle,
-            text=True,
-            close_fds=True,
-            bufsize=1  # Line buffered
-        )
+    except Exception as e:
+        logger.error(f"Error starting stream for {camera_id}: {str(e)}")
+        return None
+
+def stream_all_rtsp_to_rtmp(streams):
+    """Remux several (camera_id, rtsp_url, rtmp_url, audio) streams in one FFmpeg process"""
+    try:
+        # -xerror ends the process on input errors such as socket timeouts, which
+        # FFmpeg otherwise treats like EOF. Verbose logging with level tags lets
+        # watch_combined_output() spot outputs that end while the rest carry on.
+        command = ['ffmpeg', '-hide_banner', '-loglevel', 'level+verbose', '-nostats', '-xerror']
+        for _, rtsp_url, _, _ in streams:
+            command += build_input_args(rtsp_url)
         
-        # Save the log handle to close it later
-        process.log_handle = log_handle
+        for index, (camera_id, rtsp_url, rtmp_url, audio) in enumerate(streams):
+            command += ['-map', f'{index}:v:0']
+            if audio:
+                command += ['-map', f'{index}:a:0?']
+            command += build_output_args(rtmp_url, audio)
+            logger.info(f"Starting stream for {camera_id}: {rtsp_url} -> {rtmp_url}")
         
-        # Return process so it can be terminated later if needed
-        return process
+        camera_ids = [camera_id for camera_id, _, _, _ in streams]
+        return spawn_ffmpeg(command, lambda process: watch_combined_output(process, camera_ids))
         
     except Exception as e:
-        logger.error(f"Error starting stream for {camera_id}: {str(e)}")
-        if 'log_handle' in locals():
-            log_handle.close()
+        logger.error(f"Error starting combined stream: {str(e)}")
         return None
 
+def probe_rtsp_urls(rtsp_urls):
+    """Probe several RTSP URLs concurrently, returning a list of stream type sets"""
+    if not rtsp_urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(32, len(rtsp_urls))) as executor:
+        return list(executor.map(probe_rtsp_url, rtsp_urls))
+
 def load_camera_data(csv_file='cameras.csv'):
-    """Load camera data from CSV file"""
-    cameras = []
+    """Load camera data from CSV file as {camera_id: (rtsp_url, rtmp_url, audio)}"""
+    cameras = {}
     try:
-        with open(csv_file, 'r') as file:
+        with open(csv_file, 'r', newline='') as file:
             reader = csv.reader(file)
             for row in reader:
-                if len(row) >= 3:
-                    camera_id = row[0]
-                    rtsp_url = row[1]
-                    rtmp_url = row[2]
-                    cameras.append((camera_id, rtsp_url, rtmp_url))
+                # Skip blank, short and commented-out rows
+                if len(row) < 3 or row[0].startswith('#'):
+                    continue
+                # Optional 4th column forces audio on (1) or off (0); otherwise
+                # audio is streamed only if the camera has an audio track
+                audio = None
+                if len(row) >= 4 and row[3].strip() in ('0', '1'):
+                    audio = row[3].strip() == '1'
+                cameras[row[0]] = (row[1], row[2], audio)
     except Exception as e:
         logger.error(f"Error loading camera data from {csv_file}: {str(e)}")
     
     return cameras
 
-def cleanup_processes(processes):
-    """Terminate all processes"""
+def cleanup_processes(processes, grace_period=5):
+    """Terminate all process groups, killing any that outlive the grace period"""
     logger.info("Cleaning up processes...")
     for camera_id, process in processes.items():
+        process.terminating = True
         try:
-            process.terminate()
-            # Close the log file handle
-            if hasattr(process, 'log_handle'):
-                process.log_handle.close()
+            os.killpg(process.pid, signal.SIGTERM)
             logger.info(f"Terminated stream for {camera_id}")
+        except ProcessLookupError:
+            pass
         except Exception as e:
             logger.error(f"Error terminating stream for {camera_id}: {str(e)}")
+    
+    deadline = time.time() + grace_period
+    for camera_id, process in processes.items():
+        try:
+            process.wait(timeout=max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Stream for {camera_id} ignored SIGTERM, killing it")
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
 
 def run_as_daemon():
     """Run the script as a daemon process"""
@@ -153,19 +415,28 @@ def run_as_daemon():
     atexit.register(lambda: os.path.exists(pid_file) and os.remove(pid_file))
 
 def main():
+    global FFMPEG_CAPS, FFMPEG_MAJOR_VERSION
+    
     # Check if running in background mode
-    daemon_mode = False
-    if len(sys.argv) > 1 and sys.argv[1] == '--daemon':
-        daemon_mode = True
+    daemon_mode = len(sys.argv) > 1 and sys.argv[1] == '--daemon'
+    setup_logging(daemon_mode)
+    if daemon_mode:
         run_as_daemon()
         logger.info("Running in daemon mode")
     
     # Check if FFmpeg is installed
     try:
-        subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        result = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
     except (subprocess.SubprocessError, FileNotFoundError):
         logger.error("FFmpeg is not installed or not found in PATH. Please install FFmpeg.")
         sys.exit(1)
+    FFMPEG_MAJOR_VERSION = parse_ffmpeg_major_version(result.stdout)
+    
+    # Detect FFmpeg features once so streams don't have to. Only transcoding needs
+    # them, and test-encoding on every hardware encoder takes a while
+    if TRANSCODE_VIDEO:
+        FFMPEG_CAPS = detect_ffmpeg_caps()
+        logger.info(f"Transcoding video with {select_h264_encoder()}")
     
     # Create CSV file if it doesn't exist
     if not os.path.exists('cameras.csv'):
@@ -191,59 +462,147 @@ def main():
     # Store processes to keep track of them
     processes = {}
     
-    # Register cleanup handler for graceful exit
+    # Register handler for graceful exit. It only flags the main loop, which does
+    # the logging and cleanup outside of signal context.
+    stop_event = threading.Event()
+    
     def signal_handler(sig, frame):
-        logger.info("Received termination signal")
-        cleanup_processes(processes)
-        sys.exit(0)
+        stop_event.set()
     
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    # Check RTSP URLs and start streaming
-    for camera_id, rtsp_url, rtmp_url in cameras:
-        logger.info(f"Checking camera {camera_id}...")
+    # Every handled signal writes a byte to this pipe, waking the supervisor. Child
+    # exits get a no-op handler just for that; they are not reaped here, since that
+    # would steal exit statuses from Popen and the ffprobe checks.
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda sig, frame: None)
+    
+    # Cameras carried by each supervised FFmpeg process: one process per camera,
+    # or a single process for all of them when remuxing in combined mode
+    combine = COMBINE_STREAMS
+    if combine and TRANSCODE_VIDEO:
+        logger.warning("STREAM_COMBINE is ignored while transcoding; using one process per camera")
+        combine = False
+    if combine and FFMPEG_MAJOR_VERSION is not None and FFMPEG_MAJOR_VERSION < 7:
+        logger.warning("STREAM_COMBINE needs FFmpeg 7 or later; using one process per camera")
+        combine = False
+    if combine:
+        groups = {COMBINED_STREAM_ID: list(cameras)}
+    else:
+        groups = {camera_id: [camera_id] for camera_id in cameras}
+    
+    def probe_cameras(camera_ids):
+        """Probe the given cameras concurrently, keyed by camera id"""
+        return dict(zip(camera_ids, probe_rtsp_urls([cameras[camera_id][0] for camera_id in camera_ids])))
+    
+    def start_stream(stream_id, probes):
+        """Start the FFmpeg process for stream_id with those of its cameras that probed OK.
         
-        # Validate RTSP URL
-        if is_rtsp_url_valid(rtsp_url):
-            # Start streaming
-            process = stream_rtsp_to_rtmp(camera_id, rtsp_url, rtmp_url)
-            if process:
-                processes[camera_id] = process
+        The process remembers the probe results of the cameras it carries in .cameras.
+        """
+        ready = []
+        for camera_id in groups[stream_id]:
+            streams = probes[camera_id]
+            if not streams:
+                logger.warning(f"Skipping camera {camera_id} due to invalid RTSP URL")
+                continue
+            rtsp_url, rtmp_url, audio = cameras[camera_id]
+            has_audio = audio if audio is not None else 'audio' in streams
+            ready.append((camera_id, rtsp_url, rtmp_url, has_audio))
+        
+        if not ready:
+            return None
+        if stream_id == COMBINED_STREAM_ID:
+            process = stream_all_rtsp_to_rtmp(ready)
         else:
-            logger.warning(f"Skipping camera {camera_id} due to invalid RTSP URL")
+            process = stream_rtsp_to_rtmp(*ready[0])
+        if process:
+            process.cameras = {camera_id: probes[camera_id] for camera_id, _, _, _ in ready}
+        return process
+    
+    # Consecutive restart failures per stream: stream_id -> (count, next_retry_ts).
+    # next_retry_ts is None while the stream is running.
+    failure_state = {}
+    
+    def schedule_restart(stream_id):
+        """Back off exponentially before restarting, giving up after too many failures"""
+        count = failure_state.get(stream_id, (0, None))[0] + 1
+        if count > MAX_RESTART_ATTEMPTS:
+            logger.error(f"Giving up on {stream_id} after {MAX_RESTART_ATTEMPTS} failed restarts")
+            failure_state.pop(stream_id, None)
+            return
+        # Jitter keeps streams that failed together from retrying in lockstep
+        delay = min(MAX_RESTART_BACKOFF, 2 ** count) + random.uniform(0, 2)
+        failure_state[stream_id] = (count, time.time() + delay)
+        logger.info(f"Retrying {stream_id} in {delay:.1f}s (attempt {count})")
+    
+    # Probe RTSP URLs concurrently and start streaming. Cameras that fail their
+    # probe are retried with backoff, just like streams that stop later on.
+    logger.info(f"Checking {len(cameras)} cameras...")
+    probes = probe_cameras(list(cameras))
+    for stream_id in groups:
+        process = start_stream(stream_id, probes)
+        if process:
+            processes[stream_id] = process
+        if not process or len(process.cameras) < len(groups[stream_id]):
+            schedule_restart(stream_id)
     
     # Keep the script running and monitor streams
     try:
-        while processes:
-            for camera_id, process in list(processes.items()):
-                # Check if process is still running
-                if process.poll() is not None:
-                    logger.warning(f"Stream for {camera_id} stopped with return code {process.returncode}")
-                    # Close the log file handle
-                    if hasattr(process, 'log_handle'):
-                        process.log_handle.close()
-                    
-                    # Attempt to restart
-                    for cam_id, rtsp_url, rtmp_url in cameras:
-                        if cam_id == camera_id:
-                            logger.info(f"Attempting to restart stream for {camera_id}")
-                            if is_rtsp_url_valid(rtsp_url):
-                                new_process = stream_rtsp_to_rtmp(camera_id, rtsp_url, rtmp_url)
-                                if new_process:
-                                    processes[camera_id] = new_process
-                                    logger.info(f"Stream for {camera_id} restarted")
-                                else:
-                                    logger.error(f"Failed to restart stream for {camera_id}")
-                                    del processes[camera_id]
-                            else:
-                                logger.error(f"RTSP URL for {camera_id} is no longer valid")
-                                del processes[camera_id]
-                            break
+        while (processes or failure_state) and not stop_event.is_set():
+            # Sleep until a signal arrives or the next retry is due
+            retry_times = [ts for _, ts in failure_state.values() if ts is not None]
+            timeout = max(0, min(retry_times) - time.time()) if retry_times else None
+            select.select([wakeup_read], [], [], timeout)
+            try:
+                os.read(wakeup_read, 4096)
+            except BlockingIOError:
+                pass
+            if stop_event.is_set():
+                break
+            
+            stopped = [stream_id for stream_id, process in processes.items() if process.poll() is not None]
+            for stream_id in stopped:
+                process = processes.pop(stream_id)
+                logger.warning(f"Stream for {stream_id} stopped with return code {process.returncode}")
+                # A stream that ran for a while failed afresh, so restart its backoff
+                if time.time() - process.start_time > MAX_RESTART_BACKOFF:
+                    failure_state.pop(stream_id, None)
+                schedule_restart(stream_id)
             
-            # Wait before checking again
-            time.sleep(10)
-    except KeyboardInterrupt:
+            # Restart streams whose backoff has expired, probing them concurrently.
+            # A stream still running without some of its cameras only probes those,
+            # and is restarted once any of them is back.
+            now = time.time()
+            due = [stream_id for stream_id, (_, ts) in failure_state.items() if ts is not None and ts <= now]
+            probes = probe_cameras([camera_id for stream_id in due for camera_id in groups[stream_id]
+                                    if stream_id not in processes or camera_id not in processes[stream_id].cameras])
+            for stream_id in due:
+                if stream_id in processes:
+                    if not any(probes.get(camera_id) for camera_id in groups[stream_id]):
+                        schedule_restart(stream_id)
+                        continue
+                    process = processes.pop(stream_id)
+                    cleanup_processes({stream_id: process})
+                    probes.update(process.cameras)
+                
+                logger.info(f"Attempting to restart stream for {stream_id}")
+                new_process = start_stream(stream_id, probes)
+                if new_process:
+                    processes[stream_id] = new_process
+                    logger.info(f"Stream for {stream_id} restarted")
+                    if len(new_process.cameras) < len(groups[stream_id]):
+                        schedule_restart(stream_id)
+                    else:
+                        failure_state[stream_id] = (failure_state[stream_id][0], None)
+                else:
+                    logger.error(f"Failed to restart stream for {stream_id}")
+                    schedule_restart(stream_id)
+    finally:
         logger.info("Stopping all streams...")
         cleanup_processes(processes)
 